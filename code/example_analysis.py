@@ -9,6 +9,9 @@ This script shows how to:
 3. Extract time series
 4. Calculate connectivity matrices
 
+Every sub-* folder in derivatives/fmriprep is analyzed, with subjects
+processed in parallel.
+
 Usage:
     python example_analysis.py
 
@@ -17,6 +20,9 @@ Date: November 2025
 """
 
 import os
+import gzip
+import shutil
+import fnmatch
 import numpy as np
 import pandas as pd
 from pathlib import Path
@@ -26,9 +32,13 @@ warnings.filterwarnings('ignore')
 # Try to import neuroimaging libraries
 try:
     import nibabel as nib
-    from nilearn import image, masking, signal
+    from nilearn import masking, signal
     from nilearn.connectome import ConnectivityMeasure
-    from nilearn.input_data import NiftiLabelsMasker
+    from sklearn.covariance import ledoit_wolf_shrinkage
+    from joblib import Parallel, delayed, parallel_backend
+    from scipy import linalg
+    from roi_atlas import (SUPPORTED_ATLASES, load_atlas, build_roi_indicator,
+                           cached_roi_indicator)
     print("✓ All required packages available")
 except ImportError as e:
     print(f"⚠️  Missing package: {e}")
@@ -38,52 +48,193 @@ except ImportError as e:
     exit(0)
 
 
+# pyarrow is optional: it speeds up TSV parsing and enables Parquet output
+try:
+    import pyarrow  # noqa: F401
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+CSV_ENGINE = 'pyarrow' if HAVE_PYARROW else 'c'
+
+
+def _zscore_columns(X):
+    """Z-score each column of a T x N array (population std)
+
+    Constant columns z-score to zeros, as in nilearn.signal.clean.
+    """
+    Z = X - X.mean(axis=0)
+    Z[:, X.min(axis=0) == X.max(axis=0)] = 0.0
+    std = Z.std(axis=0, ddof=0)
+    std[std < np.finfo(np.float64).eps] = 1.0
+    return Z / std
+
+
+def _clean_signals(signals, confounds, t_r, low_pass=0.1, high_pass=0.01):
+    """Detrend, band-pass, regress out confounds and z-score a T x V array
+
+    Same steps and order as nilearn.signal.clean(detrend=True,
+    standardize=True), but every projection is applied as two thin
+    matmuls, Q @ (Q.T @ X), with the orthonormal basis factored once.
+    nilearn forms the T x T projector Q @ Q.T first, which costs
+    T^2 * V instead of 2 * k * T * V.
+    """
+    n_volumes = signals.shape[0]
+    eps = np.finfo(np.float64).eps
+    
+    # Mean + linear trend as an orthonormal T x 2 basis
+    trend = np.column_stack([np.ones(n_volumes), np.arange(n_volumes)])
+    trend_basis = np.linalg.qr(trend)[0]
+    
+    basis = trend_basis.astype(signals.dtype)
+    signals = signals - basis @ (basis.T @ signals)
+    signals = signal.butterworth(signals, sampling_rate=1.0 / t_r,
+                                 low_pass=low_pass, high_pass=high_pass)
+    
+    if confounds is not None:
+        # Confounds get the same detrending and filtering, keeping the
+        # filters orthogonal to the regression (Lindquist et al., 2018)
+        confounds = np.asarray(confounds, dtype=np.float64)
+        confounds = confounds - trend_basis @ (trend_basis.T @ confounds)
+        confounds = signal.butterworth(confounds, sampling_rate=1.0 / t_r,
+                                       low_pass=low_pass, high_pass=high_pass)
+        confounds = confounds - confounds.mean(axis=0)
+        confounds_std = confounds.std(axis=0, ddof=1)
+        confounds_std[confounds_std < eps] = 1.0
+        confounds /= confounds_std
+        
+        # Rank-revealing QR; drop directions the confounds do not span
+        Q, R, _ = linalg.qr(confounds, mode='economic', pivoting=True)
+        Q = Q[:, np.abs(np.diag(R)) > eps * 100.0].astype(signals.dtype)
+        signals -= Q @ (Q.T @ signals)
+    
+    signals -= signals.mean(axis=0)
+    signals_std = signals.std(axis=0, ddof=1)
+    signals_std[signals_std < eps] = 1.0
+    signals /= signals_std
+    
+    return signals
+
+
+def decompress_once(nifti_file, cache_dir='nifti_cache'):
+    """Return an uncompressed copy of a .nii.gz, writing it on first access
+
+    Uncompressed NIfTI can be memory-mapped, so repeated loads skip gzip
+    decoding entirely (roughly 10x faster for typical BOLD runs). The copy
+    is refreshed whenever the source file is newer.
+    """
+    nifti_file = Path(nifti_file)
+    if nifti_file.suffix != '.gz':
+        return nifti_file
+    
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    uncompressed = cache_dir / nifti_file.stem
+    
+    if (not uncompressed.exists()
+            or uncompressed.stat().st_mtime < nifti_file.stat().st_mtime):
+        tmp_file = uncompressed.with_name(uncompressed.name + f'.{os.getpid()}.tmp')
+        with gzip.open(nifti_file, 'rb') as src, open(tmp_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst, length=16 * 1024 * 1024)
+        os.replace(tmp_file, uncompressed)
+    
+    return uncompressed
+
+
 class PostPreprocessingAnalysis:
     """Example analysis pipeline for fMRIPrep outputs"""
     
-    def __init__(self, fmriprep_dir, subject_id, session_id='ses-01'):
+    def __init__(self, fmriprep_dir, subject_id, session_id='ses-01', skip_volumes=0):
         self.fmriprep_dir = Path(fmriprep_dir)
         self.subject_id = subject_id
         self.session_id = session_id
         
+        # Initial (dummy / non-steady-state) volumes dropped from both the
+        # BOLD series and the confounds so they stay aligned
+        if skip_volumes < 0:
+            raise ValueError(f"skip_volumes must be non-negative, got {skip_volumes}")
+        self.skip_volumes = skip_volumes
+        
         # Paths
         self.subject_dir = self.fmriprep_dir / subject_id / session_id / 'func'
         
+        # List the directory once and match each file type against it
+        if self.subject_dir.is_dir():
+            entries = [e.name for e in os.scandir(self.subject_dir)]
+        else:
+            entries = []
+        
         # Find preprocessed BOLD file
-        bold_files = list(self.subject_dir.glob('*_space-MNI*_desc-preproc_bold.nii.gz'))
+        bold_files = fnmatch.filter(entries, '*_space-MNI*_desc-preproc_bold.nii.gz')
         if not bold_files:
             raise FileNotFoundError(f"No preprocessed BOLD files found in {self.subject_dir}")
         
-        self.bold_file = bold_files[0]
+        self.bold_file = self.subject_dir / bold_files[0]
         
         # Find confounds file
-        confounds_files = list(self.subject_dir.glob('*_desc-confounds_timeseries.tsv'))
+        confounds_files = fnmatch.filter(entries, '*_desc-confounds_timeseries.tsv')
         if not confounds_files:
             raise FileNotFoundError(f"No confounds file found in {self.subject_dir}")
         
-        self.confounds_file = confounds_files[0]
+        self.confounds_file = self.subject_dir / confounds_files[0]
         
         # Find brain mask
-        mask_files = list(self.subject_dir.glob('*_space-MNI*_desc-brain_mask.nii.gz'))
-        self.mask_file = mask_files[0] if mask_files else None
+        mask_files = fnmatch.filter(entries, '*_space-MNI*_desc-brain_mask.nii.gz')
+        self.mask_file = self.subject_dir / mask_files[0] if mask_files else None
         
         print(f"Initialized analysis for {subject_id}")
         print(f"  BOLD: {self.bold_file.name}")
         print(f"  Confounds: {self.confounds_file.name}")
         print(f"  Mask: {self.mask_file.name if self.mask_file else 'None'}")
     
-    def load_data(self):
-        """Load preprocessed fMRI data"""
+    def load_data(self, decompress=False):
+        """Load preprocessed fMRI data
+
+        The image is memory-mapped and voxel data is only read (as float32)
+        when it is first needed. Memory-mapping only applies to uncompressed
+        files; with decompress=True a local .nii copy is made once via
+        decompress_once and loaded instead.
+        """
         print("\nLoading fMRI data...")
-        self.bold_img = nib.load(self.bold_file)
-        print(f"  Shape: {self.bold_img.shape}")
+        bold_file = decompress_once(self.bold_file) if decompress else self.bold_file
+        self.bold_img = nib.load(bold_file, mmap=True)
+        
+        # Skipped volumes are dropped when the data is read (see
+        # _bold_img_float32), so only report the reduced shape here
+        n_volumes = self.bold_img.shape[3]
+        if self.skip_volumes >= n_volumes:
+            raise ValueError(f"skip_volumes={self.skip_volumes} leaves no volumes "
+                             f"in a {n_volumes}-volume run")
+        shape = self.bold_img.shape[:3] + (n_volumes - self.skip_volumes,)
+        if self.skip_volumes:
+            print(f"  Skipping {self.skip_volumes} initial volumes")
+        print(f"  Shape: {shape}")
         print(f"  TR: {self.bold_img.header.get_zooms()[3]:.2f}s")
         return self.bold_img
     
+    def _bold_img_float32(self):
+        """BOLD image materialized as float32 rather than nibabel's float64 default
+
+        Skipped initial volumes are never converted. For an array proxy the
+        raw (memory-mapped where possible) data is sliced first and the
+        scl_slope/scl_inter scaling applied in float32, since nibabel's own
+        scaling goes through float64.
+        """
+        dataobj = self.bold_img.dataobj
+        if nib.is_proxy(dataobj):
+            data = np.asarray(dataobj.get_unscaled()[..., self.skip_volumes:], dtype=np.float32)
+            if dataobj.slope != 1:
+                data *= dataobj.slope
+            if dataobj.inter != 0:
+                data += dataobj.inter
+        else:
+            data = np.asarray(dataobj[..., self.skip_volumes:], dtype=np.float32)
+        return nib.Nifti1Image(data, self.bold_img.affine, self.bold_img.header)
+    
     def load_confounds(self, confound_names=None):
         """Load and select confound regressors"""
         print("\nLoading confounds...")
-        confounds_df = pd.read_csv(self.confounds_file, sep='\t')
+        header = pd.read_csv(self.confounds_file, sep='\t', nrows=0).columns
         
         if confound_names is None:
             # Default confounds for nuisance regression
@@ -96,79 +247,87 @@ class PostPreprocessingAnalysis:
             ]
         
         # Select available confounds
-        available_confounds = [c for c in confound_names if c in confounds_df.columns]
+        available_confounds = [c for c in confound_names if c in header]
         
         if not available_confounds:
             print("  ⚠️  No standard confounds found")
             return None
         
-        confounds = confounds_df[available_confounds]
+        # Only parse the selected columns
+        confounds_df = pd.read_csv(
+            self.confounds_file,
+            sep='\t',
+            usecols=available_confounds,
+            engine=CSV_ENGINE
+        )
+        # Dropping skipped volumes here folds into the one float32 copy (the
+        # pyarrow engine cannot skip data rows below the header at parse time)
+        kept_rows = confounds_df.iloc[self.skip_volumes:]
+        confounds = kept_rows.loc[:, available_confounds].to_numpy(dtype=np.float32, copy=True)
         
         # Handle NaN values (first row for FD)
-        confounds = confounds.fillna(0)
+        np.nan_to_num(confounds, copy=False, nan=0.0)
         
         print(f"  Selected {len(available_confounds)} confounds:")
         for conf in available_confounds:
             print(f"    - {conf}")
         
-        return confounds.values
+        return confounds
     
     def apply_confound_regression(self, confounds):
         """Remove confounds from fMRI data"""
         print("\nApplying confound regression...")
         
+        bold_img = self._bold_img_float32()
+        
         # Extract time series from masked data
         if self.mask_file:
             mask_img = nib.load(self.mask_file)
         else:
             print("  Creating mask from data...")
-            mask_img = masking.compute_epi_mask(self.bold_img)
+            mask_img = masking.compute_epi_mask(bold_img)
+        
+        # Reduce to in-mask voxels (T x V) before cleaning
+        bold_data = masking.apply_mask(bold_img, mask_img, dtype=np.float32)
         
         # Clean the signal
-        cleaned_img = image.clean_img(
-            self.bold_img,
-            confounds=confounds,
-            standardize=True,
-            detrend=True,
-            low_pass=0.1,  # Low-pass filter at 0.1 Hz
-            high_pass=0.01,  # High-pass filter at 0.01 Hz
+        cleaned_data = _clean_signals(
+            bold_data,
+            confounds,
             t_r=self.bold_img.header.get_zooms()[3],
-            mask_img=mask_img
+            low_pass=0.1,  # Low-pass filter at 0.1 Hz
+            high_pass=0.01  # High-pass filter at 0.01 Hz
         )
+        # Keep the cleaned data as a 2-D in-mask array; ROI extraction
+        # works on it directly, so there is no need to unmask back to 4-D
+        self.mask_img = mask_img
         
         print("  ✓ Signal cleaned")
-        return cleaned_img
+        return cleaned_data
     
-    def extract_roi_timeseries(self, cleaned_img, atlas='aal'):
-        """Extract time series from ROIs using atlas"""
+    def extract_roi_timeseries(self, cleaned_data, atlas='aal'):
+        """Extract time series from ROIs using atlas
+
+        cleaned_data is the T x V in-mask array returned by
+        apply_confound_regression.
+        """
         print(f"\nExtracting ROI time series using {atlas.upper()} atlas...")
         
+        if atlas not in SUPPORTED_ATLASES:
+            print(f"  ⚠️  Atlas {atlas} not implemented")
+            return None, None
+        
         try:
-            from nilearn import datasets
-            
-            # Load atlas
-            if atlas == 'aal':
-                atlas_data = datasets.fetch_atlas_aal()
-                atlas_img = atlas_data.maps
-                labels = atlas_data.labels
-            elif atlas == 'harvard_oxford':
-                atlas_data = datasets.fetch_atlas_harvard_oxford('cort-maxprob-thr25-2mm')
-                atlas_img = atlas_data.maps
-                labels = atlas_data.labels
+            _, labels = load_atlas(atlas)
+            if self.mask_file:
+                indicator = cached_roi_indicator(atlas, str(self.mask_file))
             else:
-                print(f"  ⚠️  Atlas {atlas} not implemented")
-                return None, None
+                indicator = build_roi_indicator(atlas, self.mask_img)
             
-            # Create masker
-            masker = NiftiLabelsMasker(
-                labels_img=atlas_img,
-                standardize=True,
-                memory='nilearn_cache',
-                verbose=0
-            )
+            # ROI means as a single (T x V) @ (V x K) sparse product
+            timeseries = np.asarray(cleaned_data @ indicator)
             
-            # Extract time series
-            timeseries = masker.fit_transform(cleaned_img)
+            timeseries = signal.clean(timeseries, detrend=False, standardize=True)
             
             print(f"  ✓ Extracted {timeseries.shape[1]} ROIs")
             print(f"  ✓ Timeseries shape: {timeseries.shape}")
@@ -183,16 +342,45 @@ class PostPreprocessingAnalysis:
         """Compute functional connectivity matrix"""
         print(f"\nComputing {kind} connectivity...")
         
-        connectivity_measure = ConnectivityMeasure(kind=kind)
-        connectivity_matrix = connectivity_measure.fit_transform([timeseries])[0]
-        
+        if kind == 'correlation':
+            # Pearson correlation as a single GEMM on the z-scored timeseries,
+            # shrunk with the same Ledoit-Wolf estimator ConnectivityMeasure uses
+            ts = _zscore_columns(np.ascontiguousarray(timeseries))
+            shrinkage = ledoit_wolf_shrinkage(ts, assume_centered=True)
+            empirical = (ts.T @ ts) / ts.shape[0]
+            mu = np.trace(empirical) / empirical.shape[0]
+            covariance = (1.0 - shrinkage) * empirical
+            covariance.flat[::covariance.shape[0] + 1] += shrinkage * mu
+            
+            # Covariance to correlation; constant (e.g. empty) ROIs have zero
+            # variance before shrinkage and end up with 0 off the diagonal
+            std = np.sqrt(np.diag(covariance))
+            std[std == 0] = 1.0
+            connectivity_matrix = covariance / np.outer(std, std)
+            np.fill_diagonal(connectivity_matrix, 1.0)
+        else:
+            # Tangent, partial correlation, etc. still go through nilearn
+            connectivity_measure = ConnectivityMeasure(kind=kind)
+            connectivity_matrix = connectivity_measure.fit_transform([timeseries])[0]
+
         print(f"  ✓ Connectivity matrix shape: {connectivity_matrix.shape}")
         print(f"  ✓ Mean connectivity: {np.mean(connectivity_matrix):.3f}")
         
         return connectivity_matrix
     
-    def save_results(self, timeseries, connectivity_matrix, labels, output_dir='analysis_outputs'):
-        """Save analysis results"""
+    def save_results(self, timeseries, connectivity_matrix, labels, output_dir='analysis_outputs',
+                     output_format=None):
+        """Save analysis results
+
+        The labelled connectivity table is written as Parquet when pyarrow
+        is installed and as CSV otherwise; pass output_format='csv' or
+        'parquet' to choose explicitly.
+        """
+        if output_format is None:
+            output_format = 'parquet' if HAVE_PYARROW else 'csv'
+        if output_format not in ('csv', 'parquet'):
+            raise ValueError(f"output_format must be 'csv' or 'parquet', got {output_format!r}")
+        
         print(f"\nSaving results to {output_dir}/...")
         
         output_path = Path(output_dir)
@@ -215,14 +403,20 @@ class PostPreprocessingAnalysis:
                 f.write(f"{i}\t{label}\n")
         print(f"  ✓ Labels: {labels_file}")
         
-        # Save connectivity as CSV for easy viewing
-        connectivity_csv = output_path / f'{self.subject_id}_connectivity.csv'
-        pd.DataFrame(
+        # Save labelled connectivity table for easy viewing
+        connectivity_df = pd.DataFrame(
             connectivity_matrix,
             columns=labels,
             index=labels
-        ).to_csv(connectivity_csv)
-        print(f"  ✓ Connectivity CSV: {connectivity_csv}")
+        )
+        if output_format == 'csv':
+            connectivity_csv = output_path / f'{self.subject_id}_connectivity.csv'
+            connectivity_df.to_csv(connectivity_csv)
+            print(f"  ✓ Connectivity CSV: {connectivity_csv}")
+        else:
+            connectivity_parquet = output_path / f'{self.subject_id}_connectivity.parquet'
+            connectivity_df.to_parquet(connectivity_parquet, compression='zstd')
+            print(f"  ✓ Connectivity Parquet: {connectivity_parquet}")
         
         return output_path
     
@@ -239,10 +433,10 @@ class PostPreprocessingAnalysis:
         confounds = self.load_confounds()
         
         # 3. Apply confound regression
-        cleaned_img = self.apply_confound_regression(confounds)
+        cleaned_data = self.apply_confound_regression(confounds)
         
         # 4. Extract ROI time series
-        timeseries, labels = self.extract_roi_timeseries(cleaned_img, atlas='aal')
+        timeseries, labels = self.extract_roi_timeseries(cleaned_data, atlas='aal')
         
         if timeseries is not None:
             # 5. Compute connectivity
@@ -266,13 +460,33 @@ class PostPreprocessingAnalysis:
             return None
 
 
+def _analyze_one(fmriprep_dir, subject_id, session_id, skip_volumes=0):
+    """Run the complete analysis for one subject (joblib worker)"""
+    try:
+        analysis = PostPreprocessingAnalysis(
+            fmriprep_dir=fmriprep_dir,
+            subject_id=subject_id,
+            session_id=session_id,
+            skip_volumes=skip_volumes
+        )
+        return analysis.run_complete_analysis()
+    
+    except Exception as e:
+        print(f"\n❌ Error ({subject_id}): {e}")
+        print("\nPlease ensure:")
+        print("  1. fMRIPrep has been run successfully")
+        print("  2. Subject ID and session ID are correct")
+        print("  3. Required packages are installed: nibabel, nilearn")
+        return None
+
+
 def main():
     """Main function"""
     
     # Example usage
     fmriprep_dir = 'derivatives/fmriprep'
-    subject_id = 'sub-01'
     session_id = 'ses-01'
+    skip_volumes = 0  # initial non-steady-state volumes to drop
     
     print("="*60)
     print("Example Post-Preprocessing Analysis")
@@ -294,23 +508,22 @@ def main():
         print("  3. Run: python code/example_analysis.py")
         return
     
-    try:
-        # Initialize analysis
-        analysis = PostPreprocessingAnalysis(
-            fmriprep_dir=fmriprep_dir,
-            subject_id=subject_id,
-            session_id=session_id
+    # fMRIPrep also writes sub-*.html reports next to the subject folders
+    subjects = sorted(p.name for p in Path(fmriprep_dir).glob('sub-*') if p.is_dir())
+    if not subjects:
+        print(f"\n⚠️  No subject folders found in {fmriprep_dir}")
+        return
+    
+    # Subjects run in separate processes on half the cores; nilearn and
+    # BLAS are threaded themselves, so cap each worker at 2 threads
+    n_jobs = max(1, (os.cpu_count() or 2) // 2)
+    print(f"\nAnalyzing {len(subjects)} subjects with {n_jobs} parallel jobs")
+    
+    with parallel_backend('loky', inner_max_num_threads=2):
+        Parallel(n_jobs=n_jobs)(
+            delayed(_analyze_one)(fmriprep_dir, subject_id, session_id, skip_volumes)
+            for subject_id in subjects
         )
-        
-        # Run complete analysis
-        analysis.run_complete_analysis()
-        
-    except Exception as e:
-        print(f"\n❌ Error: {e}")
-        print("\nPlease ensure:")
-        print("  1. fMRIPrep has been run successfully")
-        print("  2. Subject ID and session ID are correct")
-        print("  3. Required packages are installed: nibabel, nilearn")
 
 
 if __name__ == '__main__':
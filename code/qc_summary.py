@@ -12,6 +12,7 @@ Date: November 2025
 
 import os
 import json
+import hashlib
 import pandas as pd
 import numpy as np
 from pathlib import Path
@@ -19,6 +20,219 @@ import argparse
 import warnings
 warnings.filterwarnings('ignore')
 
+# Optional accelerators - fall back to serial stdlib parsing if missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    Parallel = None
+
+try:
+    import pyarrow  # noqa: F401  (Parquet cache and Arrow-backed dtypes)
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+
+# Top-level MRIQC keys read by the parsers below; everything else
+# (provenance, software versions, etc.) is skipped when streaming
+BOLD_KEYS = frozenset([
+    'bids_meta', 'fd_mean', 'fd_num', 'fd_perc', 'snr', 'tsnr', 'gcor',
+    'dvars_std', 'dvars_nstd', 'aor', 'aqi',
+])
+T1W_KEYS = frozenset([
+    'bids_meta', 'snr_total', 'cnr', 'fber', 'efc', 'qi_1', 'qi_2', 'cjv',
+    'wm2max',
+])
+
+# Bump whenever the parsed metric tables change shape or meaning, so stale
+# Parquet caches are not reused
+CACHE_VERSION = 1
+
+
+def _read_json(json_file, keys):
+    """Read the requested top-level keys from a JSON file
+
+    orjson is preferred (fastest for small files). Otherwise ijson streams
+    parse events and only builds the values of the requested keys, so
+    large blobs such as provenance are tokenized but never materialized.
+    Falls back to the stdlib json module.
+    """
+    if orjson is not None:
+        with open(json_file, 'rb') as f:
+            raw = f.read()
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # NaN/Infinity literals (written by Python's json.dump) are
+            # not strict JSON; only the stdlib parser accepts them
+            return json.loads(raw)
+    
+    if ijson is not None:
+        data = {}
+        key = None
+        try:
+            with open(json_file, 'rb') as f:
+                for prefix, event, value in ijson.parse(f, use_float=True):
+                    if prefix == '' and event == 'map_key':
+                        key = value if value in keys else None
+                        builder = ijson.ObjectBuilder()
+                        continue
+                    if key is None:
+                        continue
+                    
+                    builder.event(event, value)
+                    # A scalar or the closing event of the value itself;
+                    # keys nested directly inside it share its prefix
+                    if prefix == key and event not in ('start_map', 'start_array', 'map_key'):
+                        data[key] = builder.value
+                        key = None
+                        if len(data) == len(keys):
+                            break
+            return data
+        except ijson.JSONError:
+            # Non-strict JSON (e.g. NaN literals); re-read with the stdlib below
+            pass
+    
+    with open(json_file, 'r') as f:
+        return json.load(f)
+
+
+def _parse_bold_json(json_file):
+    """Extract key BOLD metrics from a single MRIQC JSON"""
+    data = _read_json(json_file, BOLD_KEYS)
+    return {
+        'subject_id': data.get('bids_meta', {}).get('subject_id', 'unknown'),
+        'session_id': data.get('bids_meta', {}).get('session_id', 'unknown'),
+        'task': data.get('bids_meta', {}).get('task_id', 'unknown'),
+        'fd_mean': data.get('fd_mean', np.nan),
+        'fd_num': data.get('fd_num', np.nan),
+        'fd_perc': data.get('fd_perc', np.nan),
+        'snr': data.get('snr', np.nan),
+        'tsnr': data.get('tsnr', np.nan),
+        'gcor': data.get('gcor', np.nan),
+        'dvars_std': data.get('dvars_std', np.nan),
+        'dvars_nstd': data.get('dvars_nstd', np.nan),
+        'aor': data.get('aor', np.nan),
+        'aqi': data.get('aqi', np.nan),
+    }
+
+
+def _parse_t1w_json(json_file):
+    """Extract key T1w metrics from a single MRIQC JSON"""
+    data = _read_json(json_file, T1W_KEYS)
+    return {
+        'subject_id': data.get('bids_meta', {}).get('subject_id', 'unknown'),
+        'session_id': data.get('bids_meta', {}).get('session_id', 'unknown'),
+        'snr': data.get('snr_total', np.nan),
+        'cnr': data.get('cnr', np.nan),
+        'fber': data.get('fber', np.nan),
+        'efc': data.get('efc', np.nan),
+        'qi_1': data.get('qi_1', np.nan),
+        'qi_2': data.get('qi_2', np.nan),
+        'cjv': data.get('cjv', np.nan),
+        'wm2max': data.get('wm2max', np.nan),
+    }
+
+
+def _find_metric_files(mriqc_dir, datatype, suffix):
+    """Yield MRIQC metric JSONs under sub-*/[ses-*/]<datatype>/
+
+    Walks the BIDS layout explicitly with os.scandir rather than a
+    recursive glob.
+    """
+    if not os.path.isdir(mriqc_dir):
+        return
+    
+    for sub in os.scandir(mriqc_dir):
+        if not (sub.name.startswith('sub-') and sub.is_dir()):
+            continue
+        
+        # Sessionless layouts keep the datatype directly under the subject
+        datatype_dirs = [os.path.join(sub.path, datatype)]
+        for ses in os.scandir(sub.path):
+            if ses.name.startswith('ses-') and ses.is_dir():
+                datatype_dirs.append(os.path.join(ses.path, datatype))
+        
+        for datatype_dir in datatype_dirs:
+            if not os.path.isdir(datatype_dir):
+                continue
+            for entry in os.scandir(datatype_dir):
+                if entry.name.endswith(suffix) and entry.is_file():
+                    yield entry.path
+
+
+def _column_moments(X):
+    """NaN-skipping count, mean and sample std per column"""
+    valid = ~np.isnan(X)
+    count = valid.sum(axis=0).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(X, axis=0) / count
+        resid = np.where(valid, X - mean, 0.0)
+        std = np.sqrt((resid ** 2).sum(axis=0) / (count - 1))
+    std[count < 2] = np.nan
+    return count, mean, std
+
+
+def _order_stats(x, quantiles=(0.25, 0.5, 0.75)):
+    """min, linearly interpolated quantiles and max from one np.partition"""
+    n = len(x)
+    if n == 0:
+        return [np.nan] * (len(quantiles) + 2)
+    
+    positions = [q * (n - 1) for q in quantiles]
+    kth = {0, n - 1}
+    for pos in positions:
+        kth.update((int(np.floor(pos)), int(np.ceil(pos))))
+    part = np.partition(x, sorted(kth))
+    
+    values = [part[0]]
+    for pos in positions:
+        lo, hi = int(np.floor(pos)), int(np.ceil(pos))
+        values.append(part[lo] + (part[hi] - part[lo]) * (pos - lo))
+    values.append(part[n - 1])
+    return values
+
+
+def _describe(df):
+    """Equivalent of df.describe() for the numeric columns
+
+    Count/mean/std come from a single fused pass and the order statistics
+    from one partial sort per column, instead of a separate pass per
+    statistic.
+    """
+    numeric = df.select_dtypes('number')
+    X = np.asfortranarray(numeric.to_numpy(dtype=float, na_value=np.nan))
+    count, mean, std = _column_moments(X)
+    
+    order_stats = np.array([
+        _order_stats(X[~np.isnan(X[:, j]), j]) for j in range(X.shape[1])
+    ]).reshape(X.shape[1], 5).T
+    
+    return pd.DataFrame(
+        np.vstack([count, mean, std, order_stats]),
+        index=['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max'],
+        columns=numeric.columns
+    )
+
+
+def _parse_all(parse_func, json_files):
+    """Parse metric files in parallel (threads) when joblib is available"""
+    if Parallel is None:
+        return [parse_func(f) for f in json_files]
+    return Parallel(n_jobs=-1, prefer='threads')(
+        delayed(parse_func)(f) for f in json_files
+    )
+
 
 class MRIQCAnalyzer:
     """Analyzer for MRIQC quality metrics"""
@@ -29,65 +243,64 @@ class MRIQCAnalyzer:
         self.output_dir = Path('qc_reports')
         self.output_dir.mkdir(exist_ok=True)
         
+    def _metrics_cache_file(self, kind, json_files, keys, parse_func):
+        """Parquet cache path keyed on the metric files and their mtimes/sizes
+
+        The key also covers the table schema: CACHE_VERSION, the JSON keys
+        read and the parser's code and constants (its output column names),
+        so editing a parser invalidates the cache.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f'{CACHE_VERSION}\0{",".join(sorted(keys))}\n'.encode())
+        h.update(parse_func.__code__.co_code)
+        h.update(repr(parse_func.__code__.co_consts).encode())
+        h.update(str(self.mriqc_dir.resolve()).encode())
+        for path in sorted(str(p) for p in json_files):
+            st = os.stat(path)
+            h.update(f'{path}\0{st.st_mtime_ns}\0{st.st_size}\n'.encode())
+        return self.output_dir / f'_cache_{kind}_{h.hexdigest()}.parquet'
+    
+    def _load_metrics(self, kind, json_files, keys, parse_func):
+        """Parse metric files, reusing a Parquet cache when inputs are unchanged"""
+        if not HAVE_PYARROW:
+            return pd.DataFrame(_parse_all(parse_func, json_files))
+        
+        cache_file = self._metrics_cache_file(kind, json_files, keys, parse_func)
+        if cache_file.exists():
+            return pd.read_parquet(cache_file, dtype_backend='pyarrow')
+        
+        # Arrow-backed columns (string[pyarrow], double[pyarrow]) instead of
+        # object dtype for the ID columns; metrics stay floating point even
+        # when every value happens to be integral
+        df = pd.DataFrame(_parse_all(parse_func, json_files))
+        df = df.convert_dtypes(dtype_backend='pyarrow', convert_integer=False)
+        
+        # Drop stale caches for this modality before writing the new one
+        for old_cache in self.output_dir.glob(f'_cache_{kind}_*.parquet'):
+            old_cache.unlink()
+        df.to_parquet(cache_file, compression='zstd', index=False)
+        
+        return df
+    
     def load_bold_metrics(self):
         """Load BOLD quality metrics"""
-        bold_files = list(self.mriqc_dir.glob('sub-*/**/func/*_bold.json'))
+        bold_files = list(_find_metric_files(self.mriqc_dir, 'func', '_bold.json'))
         
         if not bold_files:
             print("WARNING: No BOLD quality metrics found")
             return None
         
-        metrics_list = []
-        for json_file in bold_files:
-            with open(json_file, 'r') as f:
-                data = json.load(f)
-                # Extract key metrics
-                metrics = {
-                    'subject_id': data.get('bids_meta', {}).get('subject_id', 'unknown'),
-                    'session_id': data.get('bids_meta', {}).get('session_id', 'unknown'),
-                    'task': data.get('bids_meta', {}).get('task_id', 'unknown'),
-                    'fd_mean': data.get('fd_mean', np.nan),
-                    'fd_num': data.get('fd_num', np.nan),
-                    'fd_perc': data.get('fd_perc', np.nan),
-                    'snr': data.get('snr', np.nan),
-                    'tsnr': data.get('tsnr', np.nan),
-                    'gcor': data.get('gcor', np.nan),
-                    'dvars_std': data.get('dvars_std', np.nan),
-                    'dvars_nstd': data.get('dvars_nstd', np.nan),
-                    'aor': data.get('aor', np.nan),
-                    'aqi': data.get('aqi', np.nan),
-                }
-                metrics_list.append(metrics)
-        
-        return pd.DataFrame(metrics_list)
+        return self._load_metrics('bold', bold_files, BOLD_KEYS, _parse_bold_json)
     
     def load_t1w_metrics(self):
         """Load T1w quality metrics"""
-        t1w_files = list(self.mriqc_dir.glob('sub-*/**/anat/*_T1w.json'))
+        t1w_files = list(_find_metric_files(self.mriqc_dir, 'anat', '_T1w.json'))
         
         if not t1w_files:
             print("WARNING: No T1w quality metrics found")
             return None
         
-        metrics_list = []
-        for json_file in t1w_files:
-            with open(json_file, 'r') as f:
-                data = json.load(f)
-                metrics = {
-                    'subject_id': data.get('bids_meta', {}).get('subject_id', 'unknown'),
-                    'session_id': data.get('bids_meta', {}).get('session_id', 'unknown'),
-                    'snr': data.get('snr_total', np.nan),
-                    'cnr': data.get('cnr', np.nan),
-                    'fber': data.get('fber', np.nan),
-                    'efc': data.get('efc', np.nan),
-                    'qi_1': data.get('qi_1', np.nan),
-                    'qi_2': data.get('qi_2', np.nan),
-                    'cjv': data.get('cjv', np.nan),
-                    'wm2max': data.get('wm2max', np.nan),
-                }
-                metrics_list.append(metrics)
-        
-        return pd.DataFrame(metrics_list)
+        return self._load_metrics('t1w', t1w_files, T1W_KEYS, _parse_t1w_json)
     
     def generate_bold_summary(self, df):
         """Generate summary statistics for BOLD data"""
@@ -95,7 +308,7 @@ class MRIQCAnalyzer:
         print("BOLD QUALITY METRICS SUMMARY")
         print("="*60)
         
-        summary = df.describe()
+        summary = _describe(df)
         print(summary)
         
         # Identify potential issues
@@ -117,8 +330,10 @@ class MRIQCAnalyzer:
         
         # Save summary to CSV
         summary_file = self.output_dir / 'bold_qc_summary.csv'
-        df.to_csv(summary_file, index=False)
-        print(f"\n✓ Summary saved to: {summary_file}")
+        if self._write_csv_if_changed(df, summary_file):
+            print(f"\n✓ Summary saved to: {summary_file}")
+        else:
+            print(f"\n✓ Summary unchanged: {summary_file}")
         
         return summary
     
@@ -128,7 +343,7 @@ class MRIQCAnalyzer:
         print("T1W QUALITY METRICS SUMMARY")
         print("="*60)
         
-        summary = df.describe()
+        summary = _describe(df)
         print(summary)
         
         # Identify potential issues
@@ -150,72 +365,88 @@ class MRIQCAnalyzer:
         
         # Save summary to CSV
         summary_file = self.output_dir / 't1w_qc_summary.csv'
-        df.to_csv(summary_file, index=False)
-        print(f"\n✓ Summary saved to: {summary_file}")
+        if self._write_csv_if_changed(df, summary_file):
+            print(f"\n✓ Summary saved to: {summary_file}")
+        else:
+            print(f"\n✓ Summary unchanged: {summary_file}")
         
         return summary
     
+    def _write_csv_if_changed(self, df, csv_file):
+        """Write df to CSV unless it matches what the previous run wrote
+
+        A content hash of the last written table is kept next to it in
+        .<name>.last_hash; returns True if the file was (re)written.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update('\0'.join(map(str, df.columns)).encode())
+        h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+        digest = h.hexdigest()
+        
+        hash_file = self.output_dir / f'.{csv_file.name}.last_hash'
+        if (csv_file.exists() and hash_file.exists()
+                and hash_file.read_text().strip() == digest):
+            return False
+        
+        df.to_csv(csv_file, index=False)
+        hash_file.write_text(digest + '\n')
+        return True
+    
+    @staticmethod
+    def _flag_rows(df, mask, metric, reason_fmt, severity):
+        """Build exclusion rows for all subjects matching a boolean mask"""
+        flagged = df.loc[mask, ['subject_id', 'session_id']]
+        # printf-style formatting of the whole column in one NumPy call
+        reasons = np.char.mod(reason_fmt, df.loc[mask, metric].to_numpy(dtype=float))
+        return flagged.assign(reason=reasons.astype(object), severity=severity)
+    
     def create_exclusion_list(self, bold_df, t1w_df):
         """Create list of subjects to potentially exclude based on QC"""
-        exclusions = []
+        columns = ['subject_id', 'session_id', 'reason', 'severity']
+        rules = []
         
         if bold_df is not None:
+            fd = bold_df['fd_mean']
+            
             # Exclude subjects with extreme motion
-            high_motion = bold_df[bold_df['fd_mean'] > 0.9]
-            for _, row in high_motion.iterrows():
-                exclusions.append({
-                    'subject_id': row['subject_id'],
-                    'session_id': row['session_id'],
-                    'reason': f'High motion (FD={row["fd_mean"]:.3f}mm)',
-                    'severity': 'high'
-                })
+            rules.append((bold_df, fd > 0.9, 'fd_mean',
+                          'High motion (FD=%.3fmm)', 'high'))
             
             # Warn about moderate motion
-            mod_motion = bold_df[(bold_df['fd_mean'] > 0.5) & (bold_df['fd_mean'] <= 0.9)]
-            for _, row in mod_motion.iterrows():
-                exclusions.append({
-                    'subject_id': row['subject_id'],
-                    'session_id': row['session_id'],
-                    'reason': f'Moderate motion (FD={row["fd_mean"]:.3f}mm)',
-                    'severity': 'moderate'
-                })
+            rules.append((bold_df, (fd > 0.5) & (fd <= 0.9), 'fd_mean',
+                          'Moderate motion (FD=%.3fmm)', 'moderate'))
             
             # Low tSNR
-            low_tsnr = bold_df[bold_df['tsnr'] < 40]
-            for _, row in low_tsnr.iterrows():
-                exclusions.append({
-                    'subject_id': row['subject_id'],
-                    'session_id': row['session_id'],
-                    'reason': f'Low tSNR ({row["tsnr"]:.2f})',
-                    'severity': 'moderate'
-                })
+            rules.append((bold_df, bold_df['tsnr'] < 40, 'tsnr',
+                          'Low tSNR (%.2f)', 'moderate'))
         
         if t1w_df is not None:
             # Very low SNR
-            low_snr = t1w_df[t1w_df['snr'] < 8]
-            for _, row in low_snr.iterrows():
-                exclusions.append({
-                    'subject_id': row['subject_id'],
-                    'session_id': row['session_id'],
-                    'reason': f'Very low SNR ({row["snr"]:.2f})',
-                    'severity': 'high'
-                })
-        
-        if exclusions:
-            exclusion_df = pd.DataFrame(exclusions)
-            exclusion_file = self.output_dir / 'suggested_exclusions.csv'
-            exclusion_df.to_csv(exclusion_file, index=False)
-            
-            print("\n" + "="*60)
-            print("SUGGESTED EXCLUSIONS")
-            print("="*60)
-            print(f"\nFound {len(exclusions)} potential quality issues:")
-            print(exclusion_df)
+            rules.append((t1w_df, t1w_df['snr'] < 8, 'snr',
+                          'Very low SNR (%.2f)', 'high'))
+        
+        # Clean cohort: skip building the table and writing the CSV
+        if not any(mask.any() for _, mask, _, _, _ in rules):
+            print("\n✓ No subjects flagged for exclusion based on QC metrics")
+            return pd.DataFrame(columns=columns)
+        
+        exclusion_df = pd.concat(
+            [self._flag_rows(*rule) for rule in rules], ignore_index=True)
+        
+        exclusion_file = self.output_dir / 'suggested_exclusions.csv'
+        written = self._write_csv_if_changed(exclusion_df, exclusion_file)
+        
+        print("\n" + "="*60)
+        print("SUGGESTED EXCLUSIONS")
+        print("="*60)
+        print(f"\nFound {len(exclusion_df)} potential quality issues:")
+        print(exclusion_df)
+        if written:
             print(f"\n✓ Exclusion list saved to: {exclusion_file}")
         else:
-            print("\n✓ No subjects flagged for exclusion based on QC metrics")
+            print(f"\n✓ Exclusion list unchanged: {exclusion_file}")
         
-        return exclusions
+        return exclusion_df
     
     def run(self):
         """Run complete QC analysis"""
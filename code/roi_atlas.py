@@ -0,0 +1,87 @@
+"""
+Atlas helpers for example_analysis.py
+
+Atlas loading and ROI indicators are cached per process. They live in their
+own importable module so joblib workers resolve the caches by reference,
+instead of receiving pickled copies of functions defined in __main__.
+
+Author: Neuroimaging Pipeline
+Date: November 2025
+"""
+
+import functools
+import numpy as np
+import nibabel as nib
+from nilearn import image
+from joblib import Memory
+from scipy import sparse
+
+
+SUPPORTED_ATLASES = ('aal', 'harvard_oxford')
+
+
+def _download_atlas(atlas):
+    """Fetch atlas image and labels"""
+    from nilearn import datasets
+    
+    if atlas == 'aal':
+        atlas_data = datasets.fetch_atlas_aal()
+    elif atlas == 'harvard_oxford':
+        atlas_data = datasets.fetch_atlas_harvard_oxford('cort-maxprob-thr25-2mm')
+    else:
+        raise ValueError(f"Atlas {atlas} not implemented")
+    
+    return atlas_data.maps, list(atlas_data.labels)
+
+
+def fetch_atlas(atlas):
+    """Atlas image and labels from an on-disk cache under nilearn_cache/
+
+    The joblib Memory is created on first use rather than at import, so
+    importing this module does not create the cache directory.
+    """
+    memory = Memory(location='nilearn_cache', verbose=0)
+    return memory.cache(_download_atlas)(atlas)
+
+
+@functools.lru_cache(maxsize=4)
+def load_atlas(atlas):
+    """Atlas image and labels, shared across subjects in a process"""
+    atlas_img, labels = fetch_atlas(atlas)
+    return image.load_img(atlas_img), labels
+
+
+def build_roi_indicator(atlas, mask_img):
+    """Sparse V x K matrix that averages in-mask voxels into atlas ROIs
+
+    The atlas is resampled (nearest neighbour) onto the mask grid, matching
+    what NiftiLabelsMasker does with resampling_target='data'. Each column
+    holds 1/n_voxels for the voxels of one ROI, so signal @ indicator gives
+    the ROI means. ROIs with no in-mask voxels get an all-zero column.
+    """
+    atlas_img, _ = load_atlas(atlas)
+    atlas_resampled = image.resample_to_img(atlas_img, mask_img, interpolation='nearest')
+    atlas_data = np.asarray(atlas_resampled.dataobj).astype(int)
+    
+    roi_labels = np.unique(atlas_data)
+    roi_labels = roi_labels[roi_labels != 0]
+    
+    mask_bool = np.asarray(mask_img.dataobj).astype(bool)
+    label_of_voxel = atlas_data[mask_bool]
+    
+    voxels = np.flatnonzero(label_of_voxel)
+    columns = np.searchsorted(roi_labels, label_of_voxel[voxels])
+    indicator = sparse.csr_matrix(
+        (np.ones(len(voxels), dtype=np.float32), (voxels, columns)),
+        shape=(len(label_of_voxel), len(roi_labels))
+    )
+    
+    roi_sizes = np.asarray(indicator.sum(axis=0)).ravel()
+    scale = np.divide(1.0, roi_sizes, out=np.zeros_like(roi_sizes), where=roi_sizes > 0)
+    return (indicator @ sparse.diags(scale)).tocsr()
+
+
+@functools.lru_cache(maxsize=8)
+def cached_roi_indicator(atlas, mask_file):
+    """ROI indicator for a mask on disk, computed once per (atlas, mask)"""
+    return build_roi_indicator(atlas, nib.load(mask_file))